@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# Tests for build-si-containers deploy, using a fake docker in place of a
+# registry. Run with: pytest test_deploy.py
+
+import hashlib
+import importlib.machinery
+import importlib.util
+import json
+import os
+import subprocess
+import threading
+
+import pytest
+
+here = os.path.abspath(os.path.dirname(__file__))
+
+# build-si-containers has no .py extension, so load it by path
+loader = importlib.machinery.SourceFileLoader(
+    "build_si_containers", os.path.join(here, "build-si-containers")
+)
+spec = importlib.util.spec_from_loader(loader.name, loader)
+bsc = importlib.util.module_from_spec(spec)
+loader.exec_module(bsc)
+
+registry = "localhost:5000/buildsi"
+container = "%s/libabigail-test-zlib:latest" % registry
+push_output = (
+    "aaa: Pushed\n"
+    "bbb: Layer already exists\n"
+    "ccc: Pushed\n"
+    "ddd: Mounted from buildsi/libabigail\n"
+)
+
+# The raw index a registry returns for a containerd image store build
+raw_index = b'{"mediaType":"application/vnd.oci.image.index.v1+json"}'
+index_digest = "sha256:%s" % hashlib.sha256(raw_index).hexdigest()
+
+
+class FakeDocker:
+    """
+    Stand in for subprocess.run, answering docker commands like a registry:2.
+    """
+
+    def __init__(
+        self, manifests=None, repo_digests=None, push_failures=0, image_id=None
+    ):
+        self.manifests = manifests or {}
+        self.repo_digests = repo_digests or []
+        self.push_failures = push_failures
+        self.image_id = image_id or "sha256:config"
+        self.indexes = {}
+        self.missing = set()
+        self.pushes = []
+        self.lock = threading.Lock()
+
+    def __call__(self, cmd, **kwargs):
+        name = cmd[-1]
+        if cmd[1:3] == ["image", "inspect"]:
+            if name in self.missing:
+                return self.result(cmd, 1, "Error: No such image: %s" % name)
+            digests = json.dumps(self.repo_digests, separators=(",", ":"))
+            out = "%s 1000 linux amd64 %s\n" % (self.image_id, digests)
+            return self.result(cmd, 0, out)
+
+        if cmd[1:3] == ["manifest", "inspect"]:
+            if name not in self.manifests:
+                return self.result(cmd, 1, "", "no such manifest: %s" % name)
+            return self.result(cmd, 0, json.dumps(self.manifests[name]))
+
+        if cmd[1:3] == ["buildx", "imagetools"]:
+            if name not in self.indexes:
+                return self.result(cmd, 1, "", "not found")
+            return subprocess.CompletedProcess(cmd, 0, self.indexes[name], b"")
+
+        if cmd[1] == "push":
+            with self.lock:
+                self.pushes.append(name)
+                if self.push_failures:
+                    self.push_failures -= 1
+                    return self.result(cmd, 1, "received unexpected HTTP status")
+                self.manifests[name] = manifest("sha256:manifest", "sha256:config")
+            return self.result(cmd, 0, push_output)
+        raise ValueError("Unexpected command %s" % cmd)
+
+    def result(self, cmd, returncode, out, err=""):
+        return subprocess.CompletedProcess(
+            cmd, returncode, out.encode("utf-8"), err.encode("utf-8")
+        )
+
+
+def manifest(digest, config, platform=None, layers=None):
+    """
+    A manifest as returned by docker manifest inspect --verbose
+    """
+    descriptor = {"digest": digest}
+    if platform:
+        descriptor["platform"] = {"os": platform[0], "architecture": platform[1]}
+    return {
+        "Ref": container,
+        "Descriptor": descriptor,
+        "OCIManifest": {
+            "config": {"digest": config},
+            "layers": [{"size": size} for size in layers or [10, 20, 30]],
+        },
+    }
+
+
+def index():
+    """
+    An image index with an image for two platforms and an attestation.
+    """
+    return [
+        manifest("sha256:amd64", "sha256:amd64-config", ("linux", "amd64")),
+        manifest("sha256:arm64", "sha256:arm64-config", ("linux", "arm64"), [500]),
+        manifest("sha256:attest", "sha256:attest-config", ("unknown", "unknown"), [7]),
+    ]
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(bsc.time, "sleep", delays.append)
+    return delays
+
+
+def get_setup(monkeypatch, docker):
+    monkeypatch.setattr(bsc.subprocess, "run", docker)
+    monkeypatch.setattr(bsc.TestSetup, "docker_images", lambda self: None)
+    return bsc.TestSetup(here, registry=registry)
+
+
+def test_deploy_skips_matching_repo_digest(monkeypatch):
+    docker = FakeDocker(
+        manifests={container: manifest("sha256:pushed", "sha256:other")},
+        repo_digests=["%s@sha256:pushed" % container.rsplit(":", 1)[0]],
+    )
+    summary = get_setup(monkeypatch, docker).deploy([container])
+    assert summary[container]["status"] == "up to date"
+    assert summary[container]["compressed"] == 60
+    assert docker.pushes == []
+
+
+def test_deploy_skips_matching_config_digest(monkeypatch):
+    docker = FakeDocker(
+        manifests={container: manifest("sha256:pushed", "sha256:config")}
+    )
+    summary = get_setup(monkeypatch, docker).deploy([container])
+    assert summary[container]["status"] == "up to date"
+    assert docker.pushes == []
+
+
+def test_deploy_force_pushes_matching_image(monkeypatch):
+    docker = FakeDocker(
+        manifests={container: manifest("sha256:pushed", "sha256:config")}
+    )
+    summary = get_setup(monkeypatch, docker).deploy([container], force=True)
+    assert summary[container]["status"] == "pushed"
+    assert docker.pushes == [container]
+
+
+def test_deploy_pushes_missing_manifest(monkeypatch, sleeps):
+    docker = FakeDocker()
+    summary = get_setup(monkeypatch, docker).deploy([container])
+    result = summary[container]
+    assert docker.pushes == [container]
+    assert result["status"] == "pushed"
+    assert result["size"] == 1000
+    assert result["compressed"] == 60
+    assert result["layers"] == "2/4"
+    assert result["mounted"] == 1
+    assert "seconds" in result
+    assert sleeps == []
+
+
+def test_deploy_missing_manifest_logs_error(monkeypatch, caplog):
+    docker = FakeDocker()
+    get_setup(monkeypatch, docker).deploy([container])
+    assert "no such manifest: %s" % container in caplog.text
+
+
+def test_deploy_skips_matching_index_digest(monkeypatch):
+    docker = FakeDocker(manifests={container: index()}, image_id=index_digest)
+    docker.indexes[container] = raw_index
+    summary = get_setup(monkeypatch, docker).deploy([container])
+    assert summary[container]["status"] == "up to date"
+    assert docker.pushes == []
+
+    # Only the manifest for the local platform is counted
+    assert summary[container]["compressed"] == 60
+
+
+def test_deploy_pushes_unmatched_index(monkeypatch, caplog):
+    docker = FakeDocker(manifests={container: index()}, image_id="sha256:other")
+    docker.indexes[container] = raw_index
+    summary = get_setup(monkeypatch, docker).deploy([container])
+    assert summary[container]["status"] == "pushed"
+    assert docker.pushes == [container]
+    assert "is a manifest list in the registry" in caplog.text
+
+
+def test_deploy_retries_with_backoff(monkeypatch, sleeps, capsys):
+    docker = FakeDocker(push_failures=10)
+    setup = get_setup(monkeypatch, docker)
+    with pytest.raises(SystemExit) as exit:
+        setup.deploy([container], retries=3)
+    assert "Error deploying %s" % container in str(exit.value)
+    assert docker.pushes == [container] * 4
+    assert sleeps == [2, 4, 8]
+
+    # The failed container is still reported in the summary, with a time
+    row = [line for line in capsys.readouterr().out.split("\n") if container in line]
+    assert row and row[-1].split()[1] == "failed"
+    assert row[-1].split()[-1] != "-"
+
+
+def test_deploy_retry_succeeds(monkeypatch, sleeps):
+    docker = FakeDocker(push_failures=1)
+    summary = get_setup(monkeypatch, docker).deploy([container], retries=3)
+    assert summary[container]["status"] == "pushed"
+    assert sleeps == [2]
+
+
+def test_deploy_failure_does_not_stop_others(monkeypatch, capsys):
+    other = "%s/libabigail-test-mpich:latest" % registry
+    docker = FakeDocker()
+    docker.missing.add(other)
+    setup = get_setup(monkeypatch, docker)
+    with pytest.raises(SystemExit):
+        setup.deploy([other, container], workers=2)
+    assert docker.pushes == [container]
+    out = capsys.readouterr().out
+    assert "failed" in out
+    assert "pushed" in out
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--workers", "0"],
+        ["--workers", "-2"],
+        ["--retries", "-1"],
+    ],
+)
+def test_deploy_rejects_invalid_counts(args):
+    parser = bsc.get_parser()
+    with pytest.raises(SystemExit):
+        parser.parse_args(["deploy"] + args + ["libabigail-test-zlib"])
+
+
+def test_deploy_accepts_zero_retries():
+    parser = bsc.get_parser()
+    args = parser.parse_args(["deploy", "--retries", "0", "libabigail-test-zlib"])
+    assert args.retries == 0
+    assert args.workers == 4